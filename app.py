@@ -1,176 +1,394 @@
 """
-Flask backend for the Flagging Unregistered Vehicles system.
+FastAPI backend for the Flagging Unregistered Vehicles system.
 Serves the web dashboard and provides API endpoints for detection,
 vehicle management, and statistics.
 """
 
 import os
 import uuid
-from datetime import datetime
-from flask import Flask, request, jsonify, render_template, send_from_directory
-from werkzeug.utils import secure_filename
+import asyncio
+import multiprocessing
+from functools import partial
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+import aiofiles
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import ORJSONResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 
 import database as db
-from detection import detect_and_read
+from detection import detect_and_read_batch, preload_models, use_gpu
 
 # ─── App Setup ──────────────────────────────────────────────────────
 
-app = Flask(__name__)
-app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16 MB max upload
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB max upload
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Uploads are streamed to disk 1 MB at a time
 
 # Upload folder
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "uploads")
+UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "bmp", "webp"}
 
+# YOLO + OCR are CPU-bound, so they run in a bounded pool of worker
+# processes instead of on the event loop.
+DETECTION_WORKERS = int(os.environ.get("DETECTION_WORKERS", "2"))
+
+# Uploads arriving within this window are sent to YOLO as one batch
+BATCH_WINDOW = 0.02  # seconds
+MAX_BATCH_SIZE = 8
+
+# Writing a JPEG per detected plate is off unless explicitly requested
+SAVE_PLATE_CROPS = os.environ.get("SAVE_PLATE_CROPS", "0") == "1"
+
+_batcher = None
+
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+class RequestTooLarge(HTTPException):
+    """Raised when a request body exceeds MAX_CONTENT_LENGTH."""
+
+    def __init__(self):
+        super().__init__(status_code=413, detail="File too large (max 16 MB).")
+
+
+class MaxBodySizeMiddleware:
+    """
+    Reject request bodies over MAX_CONTENT_LENGTH before they are parsed,
+    like Flask's MAX_CONTENT_LENGTH. Oversized Content-Length headers are
+    refused up front; bodies without one are counted as they stream in.
+    """
+
+    def __init__(self, app, max_size=MAX_CONTENT_LENGTH):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_size:
+            error = RequestTooLarge()
+            response = ORJSONResponse({"error": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    raise RequestTooLarge()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class DetectionBatcher:
+    """
+    Collects detection requests that arrive close together and runs them
+    through detect_and_read_batch. Each collected batch is split across the
+    pool's workers so OCR for different uploads still runs in parallel.
+    The batcher owns the process pool: make_executor builds it, and builds a
+    replacement if a worker dies and breaks the pool.
+    """
+
+    def __init__(self, make_executor, workers, window=BATCH_WINDOW, max_size=MAX_BATCH_SIZE):
+        self._make_executor = make_executor
+        self.executor = make_executor()
+        self._workers = workers
+        self._window = window
+        self._max_size = max_size
+        self._queue = asyncio.Queue()
+        self._collector = None
+        self._running = set()
+
+    def start(self):
+        self._collector = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        self._collector.cancel()
+        try:
+            await self._collector
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, filepath):
+        """Queue an image for detection and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((filepath, future))
+        return await future
+
+    async def _collect(self):
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self._window)
+            while len(batch) < self._max_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # One sub-batch per worker, run in the background so the next
+            # batch can start collecting
+            size = -(-len(batch) // self._workers)  # ceil division
+            for start in range(0, len(batch), size):
+                task = asyncio.create_task(self._run_batch(batch[start:start + size]))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, batch):
+        paths = [filepath for filepath, _ in batch]
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            results = await loop.run_in_executor(
+                executor,
+                partial(detect_and_read_batch, paths, save_crops=SAVE_PLATE_CROPS),
+            )
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                # A worker died (e.g. killed for running out of memory); only
+                # this batch fails, later ones go to a fresh pool
+                self._replace_executor(executor)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _replace_executor(self, broken):
+        # Sub-batches that shared the broken pool all fail; only the first replaces it
+        if self.executor is not broken:
+            return
+        print("[DETECTION] Worker process died; restarting the detection pool.")
+        self.executor = self._make_executor()
+        broken.shutdown(wait=False)
+
+
+def _detection_mp_context():
+    """
+    Pick how detection workers are started.
+    On CPU the models are preloaded here and workers are forked, sharing
+    the weights copy-on-write. A CUDA context can't survive a fork, so on
+    GPU (or where fork is unavailable) workers are spawned and each loads
+    its own copy.
+    """
+    if not use_gpu() and "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("spawn")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Create the detection process pool and batcher on startup, tear them down on exit."""
+    global _batcher
+    mp_context = await run_in_threadpool(_detection_mp_context)
+    if mp_context.get_start_method() == "fork":
+        await run_in_threadpool(preload_models)
+
+    _batcher = DetectionBatcher(
+        partial(
+            ProcessPoolExecutor,
+            max_workers=DETECTION_WORKERS,
+            mp_context=mp_context,
+            initializer=preload_models,
+        ),
+        DETECTION_WORKERS,
+    )
+
+    # Start every worker now so the first upload doesn't pay the model load
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(
+        loop.run_in_executor(_batcher.executor, preload_models)
+        for _ in range(DETECTION_WORKERS)
+    ))
+
+    _batcher.start()
+    try:
+        yield
+    finally:
+        await _batcher.stop()
+        _batcher = None
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(MaxBodySizeMiddleware)
+
+
+@app.exception_handler(RequestTooLarge)
+async def request_too_large(request, exc):
+    """Report oversized bodies in the same {"error": ...} shape as the other API errors."""
+    return ORJSONResponse({"error": exc.detail}, status_code=exc.status_code)
+
+
+# Uploads are mounted first so they take precedence over the generic static mount
+app.mount("/static/uploads", StaticFiles(directory=UPLOAD_FOLDER), name="uploads")
+app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
+
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "templates"))
+
+
 # ─── Initialize Database ───────────────────────────────────────────
 
 db.init_db()
 
 # ─── Page Routes ────────────────────────────────────────────────────
 
-@app.route("/")
-def landing():
+@app.get("/")
+async def landing(request: Request):
     """Serve the introductory landing page."""
-    return render_template("landing.html")
+    return templates.TemplateResponse(request, "landing.html")
 
-@app.route("/dashboard")
-def dashboard():
+@app.get("/dashboard")
+async def dashboard(request: Request):
     """Serve the main dashboard page."""
-    return render_template("index.html")
-
-
-@app.route("/static/uploads/<path:filename>")
-def serve_upload(filename):
-    """Serve uploaded and processed images."""
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    return templates.TemplateResponse(request, "index.html")
 
 
 # ─── Detection API ──────────────────────────────────────────────────
 
-@app.route("/api/detect", methods=["POST"])
-def detect():
+@app.post("/api/detect")
+async def detect(image: Optional[UploadFile] = File(None)):
     """
     Upload an image and run license plate detection + OCR.
     Returns detection results with registration status.
     """
-    if "image" not in request.files:
-        return jsonify({"error": "No image file provided."}), 400
+    if image is None:
+        return ORJSONResponse({"error": "No image file provided."}, status_code=400)
 
-    file = request.files["image"]
-    if file.filename == "":
-        return jsonify({"error": "No file selected."}), 400
+    if not image.filename:
+        return ORJSONResponse({"error": "No file selected."}, status_code=400)
 
-    if not allowed_file(file.filename):
-        return jsonify({"error": f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
+    if not allowed_file(image.filename):
+        return ORJSONResponse(
+            {"error": f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"},
+            status_code=400,
+        )
 
-    # Save uploaded file with a unique name
-    ext = file.filename.rsplit(".", 1)[1].lower()
+    # Stream the upload to disk under a unique name
+    # (the body size cap is enforced earlier by MaxBodySizeMiddleware)
+    ext = image.filename.rsplit(".", 1)[1].lower()
     unique_name = f"{uuid.uuid4().hex[:12]}.{ext}"
     filepath = os.path.join(UPLOAD_FOLDER, unique_name)
-    file.save(filepath)
+    async with aiofiles.open(filepath, "wb") as f:
+        while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
 
     try:
-        # Run detection pipeline
-        result = detect_and_read(filepath)
+        # Run detection pipeline off the event loop, batched with concurrent uploads
+        result = await _batcher.submit(filepath)
 
         if "error" in result:
-            return jsonify(result), 500
+            return ORJSONResponse(result, status_code=500)
 
         # Check each detected plate against the database
+        log_rows = []
         for detection in result["detections"]:
             plate_text = detection["plate_text"]
             if plate_text:
-                vehicle_info = db.is_vehicle_registered(plate_text)
+                vehicle_info = await run_in_threadpool(db.is_vehicle_registered, plate_text)
                 detection["is_registered"] = vehicle_info is not None
-                detection["vehicle_info"] = dict(vehicle_info) if vehicle_info else None
-
-                # Log the detection
-                db.add_detection_log(
-                    plate_number=plate_text,
-                    confidence=detection["ocr_confidence"],
-                    is_registered=detection["is_registered"],
-                    image_path=unique_name,
+                detection["vehicle_info"] = vehicle_info
+
+                log_rows.append(
+                    (plate_text, detection["ocr_confidence"], detection["is_registered"], unique_name)
                 )
             else:
                 detection["is_registered"] = False
                 detection["vehicle_info"] = None
 
+        # Log all detections from this image in one transaction
+        await run_in_threadpool(db.add_detection_logs, log_rows)
+
         # Add the uploaded image filename to the result
         result["uploaded_image"] = unique_name
 
-        return jsonify(result), 200
+        return ORJSONResponse(result)
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return ORJSONResponse({"error": str(e)}, status_code=500)
 
 
 # ─── Registered Vehicles API ────────────────────────────────────────
 
-@app.route("/api/vehicles", methods=["GET"])
-def get_vehicles():
+@app.get("/api/vehicles")
+async def get_vehicles():
     """Get all registered vehicles."""
-    vehicles = db.get_all_vehicles()
-    return jsonify({"vehicles": vehicles, "count": len(vehicles)})
+    vehicles = await run_in_threadpool(db.get_all_vehicles)
+    return ORJSONResponse({"vehicles": vehicles, "count": len(vehicles)})
 
 
-@app.route("/api/vehicles", methods=["POST"])
-def add_vehicle():
+@app.post("/api/vehicles")
+async def add_vehicle(request: Request):
     """Add a new vehicle to the registered database."""
-    data = request.get_json()
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
     if not data:
-        return jsonify({"error": "No JSON data provided."}), 400
+        return ORJSONResponse({"error": "No JSON data provided."}, status_code=400)
 
     plate_number = data.get("plate_number", "").strip()
     owner_name = data.get("owner_name", "").strip()
     vehicle_type = data.get("vehicle_type", "Car").strip()
 
     if not plate_number or not owner_name:
-        return jsonify({"error": "plate_number and owner_name are required."}), 400
+        return ORJSONResponse({"error": "plate_number and owner_name are required."}, status_code=400)
 
-    result = db.add_vehicle(plate_number, owner_name, vehicle_type)
+    result = await run_in_threadpool(db.add_vehicle, plate_number, owner_name, vehicle_type)
     status = 201 if result["success"] else 409
-    return jsonify(result), status
+    return ORJSONResponse(result, status_code=status)
 
 
-@app.route("/api/vehicles/<plate_number>", methods=["DELETE"])
-def remove_vehicle(plate_number):
+@app.delete("/api/vehicles/{plate_number}")
+async def remove_vehicle(plate_number: str):
     """Remove a vehicle from the registered database."""
-    result = db.delete_vehicle(plate_number)
+    result = await run_in_threadpool(db.delete_vehicle, plate_number)
     status = 200 if result["success"] else 404
-    return jsonify(result), status
+    return ORJSONResponse(result, status_code=status)
 
 
 # ─── Detection Logs API ─────────────────────────────────────────────
 
-@app.route("/api/logs", methods=["GET"])
-def get_logs():
+@app.get("/api/logs")
+async def get_logs(limit: int = 50):
     """Get all detection logs."""
-    limit = request.args.get("limit", 50, type=int)
-    logs = db.get_detection_logs(limit=limit)
-    return jsonify({"logs": logs, "count": len(logs)})
+    logs = await run_in_threadpool(db.get_detection_logs, limit=limit)
+    return ORJSONResponse({"logs": logs, "count": len(logs)})
 
 
 # ─── Statistics API ──────────────────────────────────────────────────
 
-@app.route("/api/stats", methods=["GET"])
-def get_stats():
+@app.get("/api/stats")
+async def get_stats():
     """Get dashboard statistics."""
-    stats = db.get_stats()
-    return jsonify(stats)
+    stats = await run_in_threadpool(db.get_stats)
+    return ORJSONResponse(stats)
 
 
 # ─── Run Server ──────────────────────────────────────────────────────
 
 if __name__ == "__main__":
+    import uvicorn
+
     print("=" * 60)
     print("  Flagging Unregistered Vehicles - License Plate Detection")
     print("  Starting server at http://localhost:7860")
     print("=" * 60)
-    app.run(debug=True, host="0.0.0.0", port=7860)
+    uvicorn.run(app, host="0.0.0.0", port=7860)
@@ -5,24 +5,122 @@ Uses SQLite for storing registered vehicles and detection logs.
 
 import sqlite3
 import os
+import threading
 from datetime import datetime
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vehicles.db")
+PAGE_SIZE = 8192
+STORAGE_LOCK_TIMEOUT = 30  # seconds to wait for another process rebuilding the file
+
+# detected_at is stored as an integer epoch and only formatted (as ISO 8601
+# UTC) on the way out. ORDER BY clauses must qualify the column as
+# detection_logs.detected_at so they sort by the integer, not this alias.
+_DETECTED_AT_ISO = "strftime('%Y-%m-%dT%H:%M:%SZ', detected_at, 'unixepoch') AS detected_at"
+
+# In-process cache of plate lookups: plate_number -> vehicle row (or None).
+# The registered set is small and changes rarely. Triggers bump a version row
+# in cache_versions in the same transaction as any change to it, and every
+# lookup compares that row with _cache_version first, so a write made by
+# any process empties the cache of every process. Results are only stored
+# under the version read before the lookup, under _write_lock.
+VEHICLE_CACHE_SIZE = 4096
+_vehicle_cache = {}
+_cache_version = -1
+_MISSING = object()
+
+# One long-lived connection per thread keeps the page cache warm across
+# requests. Writes are serialized in-process so threads don't hit SQLITE_BUSY.
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def _apply_pragmas(conn):
+    """Apply per-connection tuning PRAGMAs (these are not persisted in the file)."""
+    conn.execute("PRAGMA synchronous=NORMAL")     # Safe with WAL, avoids an fsync per commit
+    conn.execute("PRAGMA cache_size=-16000")      # 16 MiB page cache
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=134217728")    # 128 MiB memory-mapped I/O
 
 
 def get_connection():
-    """Create and return a database connection."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # Return rows as dictionaries
-    conn.execute("PRAGMA journal_mode=WAL")
+    """Return this thread's database connection, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        _apply_pragmas(conn)
+        _local.conn = conn
     return conn
 
 
+def _fetch_dicts(sql, params=()):
+    """
+    Run a query and return its rows as plain dicts.
+    Builds them straight from tuples, which is cheaper than going through
+    sqlite3.Row and then dict() for every row.
+    """
+    cursor = get_connection().cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def _storage_ready():
+    """True once the file has the target page size and is in WAL mode."""
+    conn = sqlite3.connect(DB_PATH, timeout=STORAGE_LOCK_TIMEOUT)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    finally:
+        conn.close()
+    return page_size == PAGE_SIZE and journal_mode.lower() == "wal"
+
+
+def _init_storage():
+    """
+    Set the page size and enable WAL mode.
+    Both are persisted in the database header, so this only needs to run once.
+    Several processes may start at once, so the rebuild is serialized and the
+    header is re-checked once the lock is held.
+    """
+    if _storage_ready():
+        return
+
+    # journal_mode changes and VACUUM can't run inside a transaction on the
+    # database itself, so a write transaction on a small side file is the lock
+    lock = sqlite3.connect(DB_PATH + ".init-lock", timeout=STORAGE_LOCK_TIMEOUT, isolation_level=None)
+    try:
+        lock.execute("BEGIN IMMEDIATE")
+        if _storage_ready():
+            return
+
+        conn = sqlite3.connect(DB_PATH, timeout=STORAGE_LOCK_TIMEOUT)
+        try:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            if page_size != PAGE_SIZE:
+                # The page size cannot change while in WAL mode; rebuild the file first
+                conn.execute("PRAGMA journal_mode=DELETE")
+                conn.execute(f"PRAGMA page_size={PAGE_SIZE}")
+                conn.execute("VACUUM")
+            conn.execute("PRAGMA journal_mode=WAL")
+        finally:
+            conn.close()
+    finally:
+        lock.close()
+
+
 def init_db():
     """Initialize database tables and seed sample data."""
+    _init_storage()
     conn = get_connection()
     cursor = conn.cursor()
 
+    # Schema setup, migration and seeding all happen in one write transaction,
+    # so several processes starting at once (uvicorn --workers N) run them
+    # one after another and later ones see the finished schema
+    cursor.execute("BEGIN IMMEDIATE")
+
     # Create registered_vehicles table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS registered_vehicles (
@@ -34,7 +132,15 @@ def init_db():
         )
     """)
 
-    # Create detection_logs table
+    # Older databases stored detected_at as DATETIME text; move them aside to migrate.
+    # Checked inside the transaction so a table another process already
+    # migrated is never converted twice.
+    columns = {col[1]: col[2] for col in cursor.execute("PRAGMA table_info(detection_logs)")}
+    legacy_logs = columns.get("detected_at", "INTEGER").upper() != "INTEGER"
+    if legacy_logs:
+        cursor.execute("ALTER TABLE detection_logs RENAME TO detection_logs_legacy")
+
+    # Create detection_logs table (detected_at is a Unix epoch in seconds, UTC)
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS detection_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -42,11 +148,50 @@ def init_db():
             confidence REAL DEFAULT 0.0,
             is_registered BOOLEAN DEFAULT 0,
             image_path TEXT,
-            detected_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            detected_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
         )
     """)
 
-    conn.commit()
+    if legacy_logs:
+        # Values that are already epochs are kept as they are
+        cursor.execute("""
+            INSERT INTO detection_logs
+                (id, plate_number, confidence, is_registered, image_path, detected_at)
+            SELECT id, plate_number, confidence, is_registered, image_path,
+                   CASE WHEN typeof(detected_at) = 'integer' THEN detected_at
+                        ELSE CAST(strftime('%s', detected_at) AS INTEGER) END
+            FROM detection_logs_legacy
+        """)
+        cursor.execute("DROP TABLE detection_logs_legacy")
+        print("[DB] Migrated detection_logs.detected_at to Unix epoch integers.")
+
+    # Indexes for the newest-first listings and the flagged/registered breakdown
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_logs_detected_at ON detection_logs(detected_at DESC)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_logs_flagged ON detection_logs(is_registered, detected_at DESC)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_vehicles_added ON registered_vehicles(added_on DESC)"
+    )
+
+    # Version row for the plate lookup cache, bumped on every change to registered_vehicles
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES ('registered_vehicles')")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS registered_vehicles_{event.lower()}_version
+            AFTER {event} ON registered_vehicles
+            BEGIN
+                UPDATE cache_versions SET version = version + 1 WHERE name = 'registered_vehicles';
+            END
+        """)
 
     # Seed sample registered vehicles if table is empty
     cursor.execute("SELECT COUNT(*) FROM registered_vehicles")
@@ -72,22 +217,58 @@ def init_db():
             "INSERT INTO registered_vehicles (plate_number, owner_name, vehicle_type) VALUES (?, ?, ?)",
             sample_vehicles,
         )
-        conn.commit()
         print(f"[DB] Seeded {len(sample_vehicles)} sample registered vehicles.")
 
-    conn.close()
+    conn.commit()
+
+    # Refresh planner statistics so the indexes above get picked
+    cursor.execute("ANALYZE")
+    conn.commit()
+
+    preload_vehicle_cache()
+
+
+def _sync_vehicle_cache(conn):
+    """
+    Drop all cached plate lookups if the registered set changed since they
+    were stored (in this or any other process). Returns the current version.
+    """
+    global _cache_version
+    version = conn.execute(
+        "SELECT version FROM cache_versions WHERE name = 'registered_vehicles'"
+    ).fetchone()[0]
+    if version > _cache_version:
+        with _write_lock:
+            if version > _cache_version:
+                _vehicle_cache.clear()
+                _cache_version = version
+    return version
+
+
+def _cache_vehicle(plate_number, vehicle, version):
+    """Store a lookup result unless the registered set changed in the meantime."""
+    with _write_lock:
+        if version != _cache_version:
+            return
+        if len(_vehicle_cache) >= VEHICLE_CACHE_SIZE:
+            # Evict the oldest entry (dicts preserve insertion order)
+            _vehicle_cache.pop(next(iter(_vehicle_cache)), None)
+        _vehicle_cache[plate_number] = vehicle
+
+
+def preload_vehicle_cache():
+    """Load every registered vehicle into the lookup cache."""
+    version = _sync_vehicle_cache(get_connection())
+    rows = _fetch_dicts("SELECT * FROM registered_vehicles")
+    for row in rows[:VEHICLE_CACHE_SIZE]:
+        _cache_vehicle(row["plate_number"], row, version)
 
 
 # ─── Registered Vehicles CRUD ──────────────────────────────────────
 
 def get_all_vehicles():
     """Get all registered vehicles."""
-    conn = get_connection()
-    rows = conn.execute(
-        "SELECT * FROM registered_vehicles ORDER BY added_on DESC"
-    ).fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return _fetch_dicts("SELECT * FROM registered_vehicles ORDER BY added_on DESC")
 
 
 def add_vehicle(plate_number, owner_name, vehicle_type="Car"):
@@ -95,28 +276,27 @@ def add_vehicle(plate_number, owner_name, vehicle_type="Car"):
     plate_number = plate_number.upper().replace(" ", "").replace("-", "")
     conn = get_connection()
     try:
-        conn.execute(
-            "INSERT INTO registered_vehicles (plate_number, owner_name, vehicle_type) VALUES (?, ?, ?)",
-            (plate_number, owner_name, vehicle_type),
-        )
-        conn.commit()
-        conn.close()
-        return {"success": True, "message": f"Vehicle {plate_number} registered successfully."}
+        with _write_lock:
+            with conn:
+                conn.execute(
+                    "INSERT INTO registered_vehicles (plate_number, owner_name, vehicle_type) VALUES (?, ?, ?)",
+                    (plate_number, owner_name, vehicle_type),
+                )
     except sqlite3.IntegrityError:
-        conn.close()
         return {"success": False, "message": f"Vehicle {plate_number} is already registered."}
+    return {"success": True, "message": f"Vehicle {plate_number} registered successfully."}
 
 
 def delete_vehicle(plate_number):
     """Remove a vehicle from the registered database."""
     plate_number = plate_number.upper().replace(" ", "").replace("-", "")
     conn = get_connection()
-    cursor = conn.execute(
-        "DELETE FROM registered_vehicles WHERE plate_number = ?", (plate_number,)
-    )
-    conn.commit()
-    deleted = cursor.rowcount > 0
-    conn.close()
+    with _write_lock:
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM registered_vehicles WHERE plate_number = ?", (plate_number,)
+            )
+        deleted = cursor.rowcount > 0
     if deleted:
         return {"success": True, "message": f"Vehicle {plate_number} removed."}
     else:
@@ -127,72 +307,79 @@ def is_vehicle_registered(plate_number):
     """Check if a plate number exists in the registered database."""
     plate_number = plate_number.upper().replace(" ", "").replace("-", "")
     conn = get_connection()
+    version = _sync_vehicle_cache(conn)
+    vehicle = _vehicle_cache.get(plate_number, _MISSING)
+    if vehicle is not _MISSING:
+        return dict(vehicle) if vehicle else None
+
     row = conn.execute(
         "SELECT * FROM registered_vehicles WHERE plate_number = ?", (plate_number,)
     ).fetchone()
-    conn.close()
-    return dict(row) if row else None
+    vehicle = dict(row) if row else None
+    _cache_vehicle(plate_number, vehicle, version)
+    return dict(vehicle) if vehicle else None
 
 
 # ─── Detection Logs ────────────────────────────────────────────────
 
 def add_detection_log(plate_number, confidence, is_registered, image_path):
     """Log a detection event."""
+    add_detection_logs([(plate_number, confidence, is_registered, image_path)])
+
+
+def add_detection_logs(rows):
+    """
+    Log several detection events in a single transaction.
+    Each row is a (plate_number, confidence, is_registered, image_path) tuple.
+    """
+    if not rows:
+        return
     conn = get_connection()
-    conn.execute(
-        """INSERT INTO detection_logs 
-           (plate_number, confidence, is_registered, image_path) 
-           VALUES (?, ?, ?, ?)""",
-        (plate_number, confidence, is_registered, image_path),
-    )
-    conn.commit()
-    conn.close()
+    with _write_lock, conn:
+        conn.executemany(
+            """INSERT INTO detection_logs 
+               (plate_number, confidence, is_registered, image_path) 
+               VALUES (?, ?, ?, ?)""",
+            rows,
+        )
 
 
 def get_detection_logs(limit=50):
     """Get recent detection logs."""
-    conn = get_connection()
-    rows = conn.execute(
-        "SELECT * FROM detection_logs ORDER BY detected_at DESC LIMIT ?", (limit,)
-    ).fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+    return _fetch_dicts(
+        f"""SELECT id, plate_number, confidence, is_registered, image_path,
+                   {_DETECTED_AT_ISO}
+            FROM detection_logs ORDER BY detection_logs.detected_at DESC LIMIT ?""",
+        (limit,),
+    )
 
 
 def get_stats():
     """Get dashboard statistics."""
     conn = get_connection()
+    cursor = conn.cursor()
 
-    total_detections = conn.execute(
-        "SELECT COUNT(*) FROM detection_logs"
-    ).fetchone()[0]
-
-    registered_hits = conn.execute(
-        "SELECT COUNT(*) FROM detection_logs WHERE is_registered = 1"
-    ).fetchone()[0]
-
-    flagged_count = conn.execute(
-        "SELECT COUNT(*) FROM detection_logs WHERE is_registered = 0"
-    ).fetchone()[0]
-
-    total_vehicles = conn.execute(
-        "SELECT COUNT(*) FROM registered_vehicles"
-    ).fetchone()[0]
+    # All four counters in a single pass over detection_logs
+    total_detections, registered_hits, flagged_count, total_vehicles = cursor.execute(
+        """SELECT COUNT(*),
+                  COALESCE(SUM(is_registered), 0),
+                  COALESCE(SUM(1 - is_registered), 0),
+                  (SELECT COUNT(*) FROM registered_vehicles)
+           FROM detection_logs"""
+    ).fetchone()
 
     # Recent flagged vehicles (last 10)
-    recent_flagged = conn.execute(
-        """SELECT plate_number, detected_at FROM detection_logs 
-           WHERE is_registered = 0 ORDER BY detected_at DESC LIMIT 10"""
-    ).fetchall()
-
-    conn.close()
+    recent_flagged = _fetch_dicts(
+        f"""SELECT plate_number, {_DETECTED_AT_ISO} FROM detection_logs 
+            WHERE is_registered = 0 ORDER BY detection_logs.detected_at DESC LIMIT 10"""
+    )
 
     return {
         "total_detections": total_detections,
         "registered_hits": registered_hits,
         "flagged_count": flagged_count,
         "total_registered_vehicles": total_vehicles,
-        "recent_flagged": [dict(r) for r in recent_flagged],
+        "recent_flagged": recent_flagged,
     }
 
 
@@ -23,6 +23,7 @@ if sys.platform == 'win32':
 _yolo_model = None
 _ocr_reader = None
 _kimi_client = None
+_use_gpu = None
 
 def load_kimi():
     """Initialize Moonshot Kimi Vision client if API key is present."""
@@ -47,11 +48,42 @@ MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "best (1).
 
 # Indian license plate format patterns
 # Standard: XX00XX0000 or XX00X0000 (e.g., MH31AB1234, MH31A1234)
-PLATE_PATTERNS = [
-    re.compile(r"^[A-Z]{2}\d{2}[A-Z]{1,3}\d{4}$"),       # MH31AB1234
-    re.compile(r"^[A-Z]{2}\d{2}[A-Z]{1,2}\d{1,4}$"),      # Partial matches
-    re.compile(r"^[A-Z]{2}\s?\d{2}\s?[A-Z]{1,3}\s?\d{4}$"),  # With spaces
-]
+# Input is already stripped of spaces by clean_plate_text.
+PLATE_RE = re.compile(
+    r"^[A-Z]{2}\d{2}(?:"
+    r"[A-Z]{1,3}\d{4}"       # MH31AB1234
+    r"|[A-Z]{1,2}\d{1,4}"    # Partial matches
+    r")$"
+)
+
+# Common OCR misreads of digits as letters, applied to the district code
+DIGIT_MISREADS = str.maketrans("OISBGZ", "015862")
+NON_ALNUM_RE = re.compile(r"[^A-Z0-9]")
+
+# EasyOCR confidence at which a format-valid read stops trying more variants
+EASYOCR_MIN_CONF = 0.5
+
+# Seconds before a Tesseract fallback call is abandoned
+TESSERACT_TIMEOUT = 2
+
+# Extra pixels kept around each detected plate when cropping (x1, y1, x2, y2)
+CROP_PADDING = np.array([-10, -10, 10, 10], np.int32)
+
+# Structuring element for the morphological closing in preprocess_plate_image
+MORPH_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+
+def use_gpu():
+    """Check (once) whether a CUDA GPU is available for inference."""
+    global _use_gpu
+    if _use_gpu is None:
+        try:
+            import torch
+            _use_gpu = torch.cuda.is_available()
+        except ImportError:
+            _use_gpu = False
+        print(f"[DETECTION] Inference device: {'CUDA' if _use_gpu else 'CPU'}")
+    return _use_gpu
 
 
 def load_model():
@@ -61,6 +93,8 @@ def load_model():
         try:
             from ultralytics import YOLO
             _yolo_model = YOLO(MODEL_PATH)
+            if use_gpu():
+                _yolo_model.to("cuda")
             print(f"[DETECTION] YOLO model loaded from: {MODEL_PATH}")
         except Exception as e:
             print(f"[DETECTION] Error loading model: {e}")
@@ -73,47 +107,34 @@ def load_ocr():
     global _ocr_reader
     if _ocr_reader is None:
         import easyocr
-        _ocr_reader = easyocr.Reader(["en"], gpu=False)
+        _ocr_reader = easyocr.Reader(["en"], gpu=use_gpu())
         print("[DETECTION] EasyOCR reader initialized.")
     return _ocr_reader
 
 
+def preload_models():
+    """
+    Load YOLO and EasyOCR eagerly instead of on the first request.
+    Called in the server process before forking detection workers, so the
+    weights are shared copy-on-write, and as the worker initializer.
+    """
+    load_model()
+    load_ocr()
+
+
 def clean_plate_text(text):
     """
     Clean and normalize extracted plate text.
     Removes unwanted characters and standardizes format.
     """
     # Remove all non-alphanumeric characters
-    cleaned = re.sub(r"[^A-Za-z0-9]", "", text)
-    cleaned = cleaned.upper().strip()
-
-    # Common OCR misreads
-    replacements = {
-        "O": "0",  # Only replace O with 0 in numeric positions
-        "I": "1",
-        "S": "5",
-        "B": "8",
-        "G": "6",
-        "Z": "2",
-    }
+    cleaned = NON_ALNUM_RE.sub("", text.upper())
 
     # Apply smart replacements — only in expected digit positions
     if len(cleaned) >= 4:
-        # First 2 chars should be letters (state code)
-        state = cleaned[:2]
-        rest = cleaned[2:]
-
-        # Next 2 should be digits (district code)
-        district = ""
-        for ch in rest[:2]:
-            if ch in replacements and not ch.isdigit():
-                district += replacements[ch]
-            else:
-                district += ch
-        rest = rest[2:]
-
+        # First 2 chars should be letters (state code), next 2 digits (district code)
         # Remaining: 1-3 letters + 1-4 digits
-        cleaned = state + district + rest
+        cleaned = cleaned[:2] + cleaned[2:4].translate(DIGIT_MISREADS) + cleaned[4:]
 
     return cleaned
 
@@ -125,9 +146,8 @@ def validate_plate_format(plate_text):
     """
     cleaned = clean_plate_text(plate_text)
 
-    for pattern in PLATE_PATTERNS:
-        if pattern.match(cleaned):
-            return True, cleaned
+    if PLATE_RE.match(cleaned):
+        return True, cleaned
 
     # Even if format doesn't match perfectly, return the cleaned text
     # (OCR may not be perfect, but we still want to check the database)
@@ -137,44 +157,78 @@ def validate_plate_format(plate_text):
 def preprocess_plate_image(plate_img):
     """
     Preprocess the cropped plate image for better OCR accuracy.
-    Creates an array of different preprocessed versions to try OCR on.
+    Returns a tuple of different preprocessed versions to try OCR on:
+    (original, gray, resized, blur, otsu, adaptive, morph)
     """
-    variants = []
-    
-    # 1. Original BGR
-    variants.append(plate_img)
-    
-    # 2. Grayscale
+    # 1. Grayscale
     gray = cv2.cvtColor(plate_img, cv2.COLOR_BGR2GRAY)
-    variants.append(gray)
 
     # Resize (scale up to improve OCR resolution)
     resized = cv2.resize(gray, None, fx=2.0, fy=2.0, interpolation=cv2.INTER_CUBIC)
-    variants.append(resized)
 
-    # 3. Bilateral filter to reduce noise while keeping edges sharp
+    # 2. Bilateral filter to reduce noise while keeping edges sharp
     blur = cv2.bilateralFilter(resized, 11, 17, 17)
-    variants.append(blur)
 
-    # 4. Otsu Thresholding
+    # 3. Otsu Thresholding
     _, otsu = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    variants.append(otsu)
-    
-    # 5. Adaptive Thresholding
+
+    # 4. Adaptive Thresholding
     adaptive = cv2.adaptiveThreshold(
         blur, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2
     )
-    variants.append(adaptive)
 
-    # 6. Morphological Operations (Opening to remove noise, Closing to close small holes)
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-    morph = cv2.morphologyEx(otsu, cv2.MORPH_CLOSE, kernel)
-    variants.append(morph)
+    # 5. Morphological Closing to close small holes
+    morph = cv2.morphologyEx(otsu, cv2.MORPH_CLOSE, MORPH_KERNEL)
+
+    return (plate_img, gray, resized, blur, otsu, adaptive, morph)
+
 
-    return variants
+def ocr_candidate(cleaned_text, confidence):
+    """
+    Bundle an already-cleaned OCR read with its confidence and whether it
+    matches a plate format, so the format check runs once per candidate.
+    """
+    return (cleaned_text, confidence, PLATE_RE.match(cleaned_text) is not None)
 
 
-def detect_and_read(image_path):
+def read_easyocr(reader, img):
+    """
+    Run EasyOCR on one preprocessed plate image.
+    Returns a list of (cleaned_text, confidence, is_valid) candidates.
+    """
+    # Provide an "allowlist" to force EasyOCR to only read uppercase letters and numbers
+    ocr_result = reader.readtext(
+        img,
+        detail=1,
+        allowlist='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789',
+        paragraph=False,
+        mag_ratio=2.0  # Add internal magnification
+    )
+
+    candidates = []
+
+    # Sometimes plate text is split into multiple bounding boxes by OCR
+    # Example: ["MH20", "EE0841"]
+    if len(ocr_result) > 1:
+        # Combine multiple detections vertically/horizontally
+        combined_text = "".join([det[1] for det in ocr_result])
+        avg_conf = sum([det[2] for det in ocr_result]) / len(ocr_result)
+        cleaned_combo = clean_plate_text(combined_text)
+        if len(cleaned_combo) >= 4 and len(cleaned_combo) <= 12:
+            candidates.append(ocr_candidate(cleaned_combo, avg_conf))
+
+    # Also consider individual boxes
+    for detection in ocr_result:
+        text = detection[1]
+        ocr_conf = detection[2]
+        cleaned = clean_plate_text(text)
+        if len(cleaned) >= 4 and len(cleaned) <= 12:
+            candidates.append(ocr_candidate(cleaned, ocr_conf))
+
+    return candidates
+
+
+def detect_and_read(image_path, img=None, save_crops=False):
     """
     Main detection pipeline:
     1. Run YOLO to detect license plates
@@ -182,186 +236,216 @@ def detect_and_read(image_path):
     3. Run OCR on each crop
     4. Validate and return results
     
+    If the caller already has the decoded BGR image it can pass it as `img`;
+    image_path is then only used to name the output files.
+    Cropped plate images are only written to disk when save_crops is True.
     Returns a list of detection results.
     """
+    return detect_and_read_batch([image_path], None if img is None else [img], save_crops)[0]
+
+
+def detect_and_read_batch(image_paths, images=None, save_crops=False):
+    """
+    Run the detection pipeline on several images at once.
+    YOLO sees the whole batch in a single predict() call; OCR then runs per plate.
+    Returns one result dict per input path, in the same order. A failure on
+    one image becomes an {"error": ..., "detections": []} result for that
+    image only.
+    """
     model = load_model()
     reader = load_ocr()
 
-    # Read the image
-    img = cv2.imread(image_path)
-    if img is None:
-        return {"error": f"Could not read image: {image_path}", "detections": []}
+    # Decode each image once; YOLO and the cropping below share the array
+    if images is None:
+        images = [cv2.imread(path) for path in image_paths]
+    readable = [img for img in images if img is not None]
+
+    # Run YOLO inference on every readable image in one call
+    # (a list of arrays is predicted as a single batch)
+    # FP16 on GPU halves weight/activation memory traffic
+    device_args = {"device": 0, "half": True} if use_gpu() else {}
+    try:
+        predictions = iter(
+            model.predict(source=readable, conf=0.25, verbose=False, **device_args)
+            if readable else []
+        )
+    except Exception as e:
+        # Fall back to one image at a time so a single bad input can't fail the rest
+        print(f"[DETECTION] Batched YOLO inference failed, retrying per image: {e}")
+        predictions = None
+
+    outputs = []
+    for image_path, img in zip(image_paths, images):
+        if img is None:
+            outputs.append({"error": f"Could not read image: {image_path}", "detections": []})
+            continue
+        try:
+            if predictions is not None:
+                result = next(predictions)
+            else:
+                result = model.predict(source=img, conf=0.25, verbose=False, **device_args)[0]
+            outputs.append(_read_plates(image_path, img, result, reader, save_crops))
+        except Exception as e:
+            print(f"[DETECTION] Detection failed for {image_path}: {e}")
+            outputs.append({"error": str(e), "detections": []})
+    return outputs
 
-    img_h, img_w = img.shape[:2]
 
-    # Run YOLO inference
-    results = model.predict(source=image_path, conf=0.25, verbose=False)
+def _read_plates(image_path, img, result, reader, save_crops=False):
+    """OCR every plate YOLO found in one image and save the annotated output."""
+    img_h, img_w = img.shape[:2]
+    image_dir, image_name = os.path.split(image_path)
 
     detections = []
     annotated_img = img.copy()
 
-    for result in results:
-        boxes = result.boxes
-        if boxes is None or len(boxes) == 0:
-            continue
-
-        for i, box in enumerate(boxes):
-            # Get bounding box coordinates
-            x1, y1, x2, y2 = map(int, box.xyxy[0].tolist())
-            conf = float(box.conf[0])
+    # Get all bounding box coordinates at once
+    boxes = result.boxes
+    if boxes is not None and len(boxes):
+        xyxy = boxes.xyxy.cpu().numpy().astype(np.int32)
+        confs = boxes.conf.cpu().numpy().tolist()
+    else:
+        xyxy = np.empty((0, 4), np.int32)
+        confs = []
 
-            # Ensure coordinates are within image bounds
-            x1 = max(0, x1)
-            y1 = max(0, y1)
-            x2 = min(img_w, x2)
-            y2 = min(img_h, y2)
+    # Ensure coordinates are within image bounds
+    bounds = np.array([img_w, img_h, img_w, img_h], np.int32)
+    np.clip(xyxy, 0, bounds, out=xyxy)
 
-            # Crop the license plate region with a slightly larger padding
-            pad = 10
-            crop_y1 = max(0, y1 - pad)
-            crop_y2 = min(img_h, y2 + pad)
-            crop_x1 = max(0, x1 - pad)
-            crop_x2 = min(img_w, x2 + pad)
+    # Crop the license plate regions with a slightly larger padding
+    crops = np.clip(xyxy + CROP_PADDING, 0, bounds)
 
-            plate_crop = img[crop_y1:crop_y2, crop_x1:crop_x2]
+    for i, ((x1, y1, x2, y2), (crop_x1, crop_y1, crop_x2, crop_y2), conf) in enumerate(
+        zip(xyxy.tolist(), crops.tolist(), confs)
+    ):
+        plate_crop = img[crop_y1:crop_y2, crop_x1:crop_x2]
 
-            if plate_crop.size == 0:
-                continue
+        if plate_crop.size == 0:
+            continue
 
-            # Preprocess the plate image into multiple variants
-            processed_variants = preprocess_plate_image(plate_crop)
+        # Preprocess the plate image into multiple variants
+        processed_variants = preprocess_plate_image(plate_crop)
 
-            # OCR collection pool
-            ocr_texts = []
+        # OCR collection pool
+        ocr_texts = []
 
-            # ─── ULTIMATE VISION: Moonshot Kimi 2.5 ───
-            kimi = load_kimi()
-            kimi_success = False
-            if kimi:
-                try:
-                    # Encode original crop to base64
-                    _, buffer = cv2.imencode('.jpg', plate_crop)
-                    encoded_string = base64.b64encode(buffer).decode('utf-8')
-                    
-                    response = kimi.chat.completions.create(
-                        model="moonshot-v1-8k-vision-preview",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": "Extract only the vehicle license plate number from this image. Output only the alphanumeric characters without any spaces, hyphens, or special characters. Do not add any explanation. Example: MH20EE0841"},
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{encoded_string}"
-                                        }
+        # ─── ULTIMATE VISION: Moonshot Kimi 2.5 ───
+        kimi = load_kimi()
+        kimi_success = False
+        if kimi:
+            try:
+                # Encode original crop to base64
+                _, buffer = cv2.imencode('.jpg', plate_crop)
+                encoded_string = base64.b64encode(buffer).decode('utf-8')
+                
+                response = kimi.chat.completions.create(
+                    model="moonshot-v1-8k-vision-preview",
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": "Extract only the vehicle license plate number from this image. Output only the alphanumeric characters without any spaces, hyphens, or special characters. Do not add any explanation. Example: MH20EE0841"},
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": f"data:image/jpeg;base64,{encoded_string}"
                                     }
-                                ]
-                            }
-                        ],
-                        temperature=0.0
-                    )
-                    
-                    raw_text = response.choices[0].message.content.strip()
-                    cleaned_kimi = clean_plate_text(raw_text)
-                    
-                    if len(cleaned_kimi) >= 4 and len(cleaned_kimi) <= 12:
-                        # Kimi gets highest confidence (0.99) since it's an LLM
-                        ocr_texts.append((cleaned_kimi, 0.99))
-                        kimi_success = True
-                        print(f"[DETECTION] Kimi Vision extracted: {cleaned_kimi}")
+                                }
+                            ]
+                        }
+                    ],
+                    temperature=0.0
+                )
+                
+                raw_text = response.choices[0].message.content.strip()
+                cleaned_kimi = clean_plate_text(raw_text)
+                
+                if len(cleaned_kimi) >= 4 and len(cleaned_kimi) <= 12:
+                    # Kimi gets highest confidence (0.99) since it's an LLM
+                    ocr_texts.append(ocr_candidate(cleaned_kimi, 0.99))
+                    kimi_success = True
+                    print(f"[DETECTION] Kimi Vision extracted: {cleaned_kimi}")
+            except Exception as e:
+                print(f"[DETECTION] Kimi Vision API error: {e}")
+
+        # ─── FALLBACK: Local OCR (EasyOCR & Tesseract) ───
+        # EasyOCR rescales/binarizes internally, so the upscaled grayscale
+        # is usually enough; the other variants are only tried until a
+        # confident, format-valid plate turns up.
+        if not kimi_success:
+            original, gray, resized, *filtered = processed_variants
+            for processed_img in (resized, original, gray, *filtered):
+                try:
+                    ocr_texts.extend(read_easyocr(reader, processed_img))
                 except Exception as e:
-                    print(f"[DETECTION] Kimi Vision API error: {e}")
-
-            # ─── FALLBACK: Local OCR (EasyOCR & Tesseract) ───
-            if not kimi_success:
-                for processed_img in processed_variants:
-                    try:
-                        # Provide an "allowlist" to force EasyOCR to only read uppercase letters and numbers
-                        ocr_result = reader.readtext(
-                            processed_img, 
-                            detail=1,
-                            allowlist='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789',
-                            paragraph=False,
-                            mag_ratio=2.0  # Add internal magnification
-                        )
-                        
-                        # Sometimes plate text is split into multiple bounding boxes by OCR
-                        # Example: ["MH20", "EE0841"]
-                        if len(ocr_result) > 1:
-                            # Combine multiple detections vertically/horizontally
-                            combined_text = "".join([det[1] for det in ocr_result])
-                            avg_conf = sum([det[2] for det in ocr_result]) / len(ocr_result)
-                            cleaned_combo = clean_plate_text(combined_text)
-                            if len(cleaned_combo) >= 4 and len(cleaned_combo) <= 12:
-                                ocr_texts.append((cleaned_combo, avg_conf))
-
-                        # Also consider individual boxes
-                        for detection in ocr_result:
-                            text = detection[1]
-                            ocr_conf = detection[2]
-                            cleaned = clean_plate_text(text)
-                            if len(cleaned) >= 4 and len(cleaned) <= 12:
-                                ocr_texts.append((cleaned, ocr_conf))
-                                
-                    except Exception as e:
-                        print(f"[DETECTION] EasyOCR error: {e}")
-                        pass
-
-            # ─── FALLBACK: Tesseract OCR ───
-            tesseract_config = r'--oem 3 --psm 8 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-            for processed_img in processed_variants:
+                    print(f"[DETECTION] EasyOCR error: {e}")
+                if any(ocr_conf >= EASYOCR_MIN_CONF and is_valid
+                       for _, ocr_conf, is_valid in ocr_texts):
+                    break
+
+        # ─── FALLBACK: Tesseract OCR ───
+        # Only needed when nothing so far matches a plate format. Every call
+        # spawns a tesseract process, so only the grayscale and Otsu variants
+        # are tried, each with a time limit.
+        have_valid = any(is_valid for _, _, is_valid in ocr_texts)
+        tesseract_config = r'--oem 3 --psm 8 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+        if not have_valid:
+            _, gray, _, _, otsu, _, _ = processed_variants
+            for processed_img in (gray, otsu):
                 try:
-                    text = pytesseract.image_to_string(processed_img, config=tesseract_config)
+                    text = pytesseract.image_to_string(
+                        processed_img, config=tesseract_config, timeout=TESSERACT_TIMEOUT
+                    )
                     cleaned = clean_plate_text(text)
                     if len(cleaned) >= 4 and len(cleaned) <= 12:
                         # We assign a baseline confidence of 0.6 for Tesseract matches
-                        ocr_texts.append((cleaned, 0.6))
+                        ocr_texts.append(ocr_candidate(cleaned, 0.6))
                 except Exception as e:
-                    # Silently fail if Tesseract is not installed
+                    # Silently fail if Tesseract is not installed or times out
                     pass
 
-            # Pick the best OCR result (longest valid text with highest confidence)
-            best_text = ""
-            best_conf = 0.0
-
-            if ocr_texts:
-                # Sort by: valid format first, then by confidence
-                for text, ocr_conf in ocr_texts:
-                    is_valid, formatted = validate_plate_format(text)
-                    score = ocr_conf + (0.5 if is_valid else 0) + (len(text) * 0.01)
-                    if score > best_conf or (score == best_conf and len(text) > len(best_text)):
-                        best_text = formatted
-                        best_conf = ocr_conf
-
-            is_valid, final_text = validate_plate_format(best_text) if best_text else (False, "")
-
-            # Save cropped plate image
-            crop_filename = f"plate_crop_{i}_{os.path.basename(image_path)}"
-            crop_path = os.path.join(os.path.dirname(image_path), crop_filename)
+        # Pick the best OCR result (longest valid text with highest confidence)
+        final_text = ""
+        best_conf = 0.0
+        is_valid = False
+
+        if ocr_texts:
+            # Sort by: valid format first, then by confidence
+            for text, ocr_conf, text_valid in ocr_texts:
+                score = ocr_conf + (0.5 if text_valid else 0) + (len(text) * 0.01)
+                if score > best_conf or (score == best_conf and len(text) > len(final_text)):
+                    final_text = text
+                    best_conf = ocr_conf
+                    is_valid = text_valid
+
+        # Save cropped plate image (opt-in; the dashboard doesn't display crops)
+        crop_filename = None
+        if save_crops:
+            crop_filename = f"plate_crop_{i}_{image_name}"
+            crop_path = os.path.join(image_dir, crop_filename)
             cv2.imwrite(crop_path, plate_crop)
 
-            # Draw bounding box on the annotated image
-            color = (0, 255, 0)  # Green
-            cv2.rectangle(annotated_img, (x1, y1), (x2, y2), color, 3)
-            label = f"{final_text} ({conf:.2f})"
-            cv2.putText(
-                annotated_img, label, (x1, y1 - 10),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2
-            )
-
-            detections.append({
-                "bbox": [x1, y1, x2, y2],
-                "detection_confidence": round(conf, 3),
-                "plate_text": final_text,
-                "ocr_confidence": round(best_conf, 3),
-                "is_valid_format": is_valid,
-                "crop_path": crop_filename,
-            })
+        # Draw bounding box on the annotated image
+        color = (0, 255, 0)  # Green
+        cv2.rectangle(annotated_img, (x1, y1), (x2, y2), color, 3)
+        label = f"{final_text} ({conf:.2f})"
+        cv2.putText(
+            annotated_img, label, (x1, y1 - 10),
+            cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2
+        )
+
+        detections.append({
+            "bbox": [x1, y1, x2, y2],
+            "detection_confidence": round(conf, 3),
+            "plate_text": final_text,
+            "ocr_confidence": round(best_conf, 3),
+            "is_valid_format": is_valid,
+            "crop_path": crop_filename,
+        })
 
     # Save annotated image
-    annotated_filename = f"annotated_{os.path.basename(image_path)}"
-    annotated_path = os.path.join(os.path.dirname(image_path), annotated_filename)
+    annotated_filename = f"annotated_{image_name}"
+    annotated_path = os.path.join(image_dir, annotated_filename)
     cv2.imwrite(annotated_path, annotated_img)
 
     return {
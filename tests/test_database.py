@@ -0,0 +1,177 @@
+"""
+Regression checks for database.init_db's detected_at migration and the
+plate lookup cache.
+Run with: python -m unittest discover tests
+"""
+
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db
+
+LEGACY_ROWS = [
+    ("MH31AB1234", 0.91, 1, "a.jpg", "2024-01-02 03:04:05"),
+    ("MH99ZZ0000", 0.42, 0, "b.jpg", "2024-06-30 23:59:59"),
+]
+
+
+def _use_database(path):
+    """Point the database module at path with no cached connection or lookups."""
+    db.DB_PATH = path
+    db._local = threading.local()
+    db._vehicle_cache.clear()
+
+
+def _init_db_in_process(path, start):
+    _use_database(path)
+    start.wait()
+    db.init_db()
+
+
+class DetectedAtMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, "vehicles.db")
+        self._original_path = db.DB_PATH
+
+        conn = sqlite3.connect(self.path)
+        conn.execute("""
+            CREATE TABLE registered_vehicles (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                plate_number TEXT UNIQUE NOT NULL,
+                owner_name TEXT NOT NULL,
+                vehicle_type TEXT NOT NULL DEFAULT 'Car',
+                added_on DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE detection_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                plate_number TEXT NOT NULL,
+                confidence REAL DEFAULT 0.0,
+                is_registered BOOLEAN DEFAULT 0,
+                image_path TEXT,
+                detected_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO detection_logs (plate_number, confidence, is_registered, image_path, detected_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            LEGACY_ROWS,
+        )
+        conn.commit()
+        self.expected = conn.execute(
+            "SELECT id, CAST(strftime('%s', detected_at) AS INTEGER) FROM detection_logs ORDER BY id"
+        ).fetchall()
+        conn.close()
+
+    def tearDown(self):
+        conn = getattr(db._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        _use_database(self._original_path)
+        self._tmp.cleanup()
+
+    def _stored_logs(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            column_type = {col[1]: col[2] for col in conn.execute("PRAGMA table_info(detection_logs)")}
+            rows = conn.execute("SELECT id, detected_at FROM detection_logs ORDER BY id").fetchall()
+            vehicles = conn.execute("SELECT COUNT(*) FROM registered_vehicles").fetchone()[0]
+        finally:
+            conn.close()
+        return column_type["detected_at"], rows, vehicles
+
+    def test_running_twice_keeps_timestamps(self):
+        _use_database(self.path)
+        db.init_db()
+        db.init_db()
+
+        column_type, rows, vehicles = self._stored_logs()
+        self.assertEqual(column_type, "INTEGER")
+        self.assertEqual(rows, self.expected)
+        self.assertEqual(vehicles, 12)
+
+    def test_concurrent_processes_keep_timestamps(self):
+        _use_database(self.path)
+        db._init_storage()
+
+        # Hold the write lock while the workers start so they all reach the
+        # migration before any of them can run it
+        blocker = sqlite3.connect(self.path, isolation_level=None)
+        blocker.execute("BEGIN IMMEDIATE")
+
+        ctx = multiprocessing.get_context("spawn")
+        start = ctx.Event()
+        workers = [
+            ctx.Process(target=_init_db_in_process, args=(self.path, start))
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        start.set()
+        time.sleep(1)
+        blocker.execute("ROLLBACK")
+        blocker.close()
+
+        for worker in workers:
+            worker.join(timeout=60)
+            self.assertEqual(worker.exitcode, 0)
+
+        column_type, rows, vehicles = self._stored_logs()
+        self.assertEqual(column_type, "INTEGER")
+        self.assertEqual(rows, self.expected)
+        self.assertEqual(vehicles, 12)
+
+
+class VehicleCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, "vehicles.db")
+        self._original_path = db.DB_PATH
+        _use_database(self.path)
+        db.init_db()
+
+    def tearDown(self):
+        db._local.conn.close()
+        _use_database(self._original_path)
+        self._tmp.cleanup()
+
+    def _other_process_write(self, sql, params):
+        # A separate connection stands in for another worker process
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute(sql, params)
+        conn.close()
+
+    def test_delete_from_another_process_is_seen(self):
+        self.assertIsNotNone(db.is_vehicle_registered("MH31AB1234"))
+        self._other_process_write("DELETE FROM registered_vehicles WHERE plate_number = ?", ("MH31AB1234",))
+        self.assertIsNone(db.is_vehicle_registered("MH31AB1234"))
+
+    def test_add_from_another_process_is_seen(self):
+        self.assertIsNone(db.is_vehicle_registered("MH01ZZ9999"))
+        self._other_process_write(
+            "INSERT INTO registered_vehicles (plate_number, owner_name) VALUES (?, ?)",
+            ("MH01ZZ9999", "Test Owner"),
+        )
+        self.assertEqual(db.is_vehicle_registered("MH01ZZ9999")["owner_name"], "Test Owner")
+
+    def test_local_writes_are_seen(self):
+        self.assertIsNone(db.is_vehicle_registered("MH01ZZ9999"))
+        db.add_vehicle("MH01ZZ9999", "Test Owner")
+        self.assertIsNotNone(db.is_vehicle_registered("MH01ZZ9999"))
+        db.delete_vehicle("MH01ZZ9999")
+        self.assertIsNone(db.is_vehicle_registered("MH01ZZ9999"))
+
+
+if __name__ == "__main__":
+    unittest.main()